@@ -3,7 +3,14 @@ import pandas as pd
 import duckdb
 import plotly.graph_objects as go
 import plotly.express as px
+import pyarrow.parquet as pq
+import pyarrow.csv as pv
+import io
 import os
+import hashlib
+import uuid
+import tempfile
+import threading
 
 # =============================================================================
 # CONFIGURATION
@@ -15,6 +22,35 @@ FILE_WATERFALL_PQ = "inventory_waterfall_deltas.parquet"
 FILE_DAILY_PQ = "inventory_demand_daily.parquet"
 FILE_VARIANCE_PQ = "demand_forecast_variance.parquet"
 
+# CSV exports are picked up when the parquet file is missing
+FILE_WATERFALL_CSV = "inventory_waterfall_deltas.csv"
+FILE_DAILY_CSV = "inventory_demand_daily.csv"
+FILE_VARIANCE_CSV = "demand_forecast_variance.csv"
+
+# Sort order of the clustered parquet copies: org/item first for row-group
+# skipping, then the column each tab filters on, then the one it orders by
+CLUSTER_KEYS = {
+    'waterfall': ["Inv Org", "Item Code", "Date", "Snapshot Date"],
+    'daily': ["Inv Org", "Item Code", "Snapshot Date", "Date"],
+    'variance': ["Inv Org", "Item Code", "Date"],
+}
+
+# DuckDB memory cap (spills to the temp directory beyond this)
+DUCKDB_MEMORY_LIMIT = "2GB"
+
+# Max points per trace sent to the browser (LTTB downsampling)
+MAX_PLOT_POINTS = 800
+# Columns of the Tab 1 detail table
+WATERFALL_DETAIL_COLUMNS = ["Snapshot Date", "Previous Snapshot Date", "Tot.Inventory_daily",
+                            "Tot.Inventory_previous", "Delta_Inventory"]
+# Waterfalls with more snapshots than this are aggregated into weekly bars
+MAX_WATERFALL_BARS = 500
+# Versions (uploads / local file mtimes) of each source kept registered in DuckDB;
+# the views and summary tables of less recently used versions are dropped
+MAX_SOURCE_VERSIONS = 8
+# Max rows shown in the variance table (the plot uses its own projected query)
+MAX_TABLE_ROWS = 1000
+
 # =============================================================================
 # DATA LOADING & DB CONNECTION
 # =============================================================================
@@ -24,8 +60,20 @@ def get_db_connection():
     """
     Creates an in-memory DuckDB connection. 
     We cache resource so it persists across reruns.
+    Threads and memory are capped so a small host is not oversubscribed, and parquet
+    footers are cached so repeated tab queries do not re-read file metadata
+    (`parquet_metadata_cache`; the legacy `enable_object_cache` pragma is kept for
+    older releases and is a no-op on current ones).
     """
     con = duckdb.connect(database=':memory:')
+    con.execute(f"PRAGMA threads={max(2, (os.cpu_count() or 4) // 2)}")
+    con.execute(f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}'")
+    con.execute("PRAGMA enable_object_cache=true")
+    try:
+        con.execute("SET parquet_metadata_cache=true")
+    except duckdb.CatalogException:
+        pass
+    con.execute(f"PRAGMA temp_directory='{os.path.join(tempfile.gettempdir(), 'duckdb')}'")
     return con
 
 con = get_db_connection()
@@ -33,72 +81,573 @@ con = get_db_connection()
 st.sidebar.header("Data Source")
 
 # Uploaders
-uploaded_wf = st.sidebar.file_uploader("Upload Waterfall Data (.parquet)", type="parquet")
-uploaded_daily = st.sidebar.file_uploader("Upload Daily Data (.parquet)", type="parquet")
-uploaded_var = st.sidebar.file_uploader("Upload Variance Data (.parquet)", type="parquet")
+uploaded_wf = st.sidebar.file_uploader("Upload Waterfall Data (.parquet / .csv)", type=["parquet", "csv"])
+uploaded_daily = st.sidebar.file_uploader("Upload Daily Data (.parquet / .csv)", type=["parquet", "csv"])
+uploaded_var = st.sidebar.file_uploader("Upload Variance Data (.parquet / .csv)", type=["parquet", "csv"])
+
+def scan_sql(path):
+    """
+    Returns the DuckDB table function that scans a local parquet or CSV file.
+    """
+    if path.lower().endswith(".csv"):
+        return f"read_csv_auto('{path}', SAMPLE_SIZE=-1)"
+    return f"read_parquet('{path}')"
+
+def narrow_columns_sql(con, path, schema):
+    """
+    Returns a select list for the source file that casts whole-number floating point
+    columns (e.g. item quantities) to INTEGER. Only lossless casts are applied:
+    a column qualifies when every value is integral and fits in int32.
+    """
+    float_cols = [name for name, col_type, *_ in schema if col_type in ("DOUBLE", "FLOAT")]
+    if not float_cols:
+        return "*"
+    checks = ", ".join(
+        f'bool_and("{c}" = round("{c}") AND "{c}" BETWEEN -2147483648 AND 2147483647)'
+        for c in float_cols
+    )
+    fits = con.execute(f"SELECT {checks} FROM {scan_sql(path)}").fetchone()
+    int_cols = [c for c, ok in zip(float_cols, fits) if ok]
+    if not int_cols:
+        return "*"
+    casts = ", ".join(f'CAST("{c}" AS INTEGER) AS "{c}"' for c in int_cols)
+    return f"* REPLACE ({casts})"
+
+def copy_to_parquet(con, select_sql, path, options):
+    """
+    Writes the query result to `path` through a temporary file in the same directory,
+    moved into place only once complete. Concurrent sessions never see a partial file
+    and an interrupted write leaves nothing behind to be reused.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        con.execute(f"COPY ({select_sql}) TO '{tmp_path}' (FORMAT PARQUET, {options})")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@st.cache_resource
+def failed_copies():
+    """
+    Returns the shared set of (copy path, source mtime) whose sorted or dim copy could
+    not be written, so an unwritable data directory is not rescanned on every rerun.
+    """
+    return set()
+
+def cluster_parquet(con, path, keys):
+    """
+    Returns a parquet copy of the parquet or CSV file sorted by `keys`, writing it once.
+    CSV sources are parsed only for this one-time copy; queries then read the parquet.
+    Clustered row groups let DuckDB skip most of the file using min/max statistics
+    when a tab filters on a single org/item, and each item's rows are stored in the
+    order the tab queries read them. Whole-number quantity columns are narrowed to
+    int32 and the copy is ZSTD compressed, so fewer bytes are read per query.
+    Falls back to the original file if the sorted copy cannot be written, and keeps
+    falling back without retrying until the source file changes.
+    """
+    root, ext = os.path.splitext(path)
+    sorted_path = f"{root}_csv_sorted.parquet" if ext.lower() == ".csv" else f"{root}_sorted.parquet"
+    mtime = os.path.getmtime(path)
+    if os.path.exists(sorted_path) and os.path.getmtime(sorted_path) >= mtime:
+        return sorted_path
+    if (sorted_path, mtime) in failed_copies():
+        return path
+    try:
+        schema = con.execute(f"DESCRIBE SELECT * FROM {scan_sql(path)}").fetchall()
+        names = [row[0] for row in schema]
+        order = ", ".join(f'"{c}"' for c in keys if c in names)
+        copy_to_parquet(
+            con,
+            f"SELECT {narrow_columns_sql(con, path, schema)} FROM {scan_sql(path)} ORDER BY {order}",
+            sorted_path,
+            "COMPRESSION ZSTD, ROW_GROUP_SIZE 100000",
+        )
+    except (duckdb.Error, OSError):
+        failed_copies().add((sorted_path, mtime))
+        return path
+    return sorted_path
+
+def dim_parquet(con, path, columns):
+    """
+    Returns a skinny parquet file holding only the distinct key columns, writing it once.
+    The selector summaries are built from it, so a cold start reads a few key columns
+    instead of the full fact file. Returns None if the file cannot be written, without
+    retrying until the source file changes.
+    """
+    root, _ = os.path.splitext(path)
+    dim_path = f"{root}_dim.parquet"
+    mtime = os.path.getmtime(path)
+    if os.path.exists(dim_path) and os.path.getmtime(dim_path) >= mtime:
+        return dim_path
+    if (dim_path, mtime) in failed_copies():
+        return None
+    cols = ", ".join(f'"{c}"' for c in columns)
+    try:
+        copy_to_parquet(
+            con,
+            f"SELECT DISTINCT {cols} FROM read_parquet('{path}') ORDER BY ALL",
+            dim_path,
+            "COMPRESSION ZSTD, ROW_GROUP_SIZE 50000",
+        )
+    except (duckdb.Error, OSError):
+        failed_copies().add((dim_path, mtime))
+        return None
+    return dim_path
+
+# Arrow tables backing uploaded files, by registered name
+uploaded_tables = {}
+
+@st.cache_resource(max_entries=8)
+def read_uploaded_table(file_id, _uploaded_file):
+    """
+    Parses an uploaded parquet or CSV file into an in-memory Arrow table, once per upload.
+    """
+    buf = io.BytesIO(_uploaded_file.getbuffer())
+    if _uploaded_file.name.lower().endswith(".csv"):
+        return pv.read_csv(buf)
+    return pq.read_table(buf)
+
+def local_source(*paths):
+    """
+    Returns the first existing local file among the candidates (or the first candidate).
+    """
+    return next((p for p in paths if os.path.exists(p)), paths[0])
+
+def db_cursor():
+    """
+    Opens a cursor on the shared connection with the uploaded Arrow tables registered.
+    Registrations are connection-local, so each cursor needs its own.
+    """
+    cur = con.cursor()
+    for name, tbl in uploaded_tables.items():
+        cur.register(name, tbl)
+    return cur
+
+def source_key(local_path, uploaded_file):
+    """
+    Identifies the current contents of a table source (upload id or local file mtime).
+    """
+    if uploaded_file is not None:
+        return uploaded_file.file_id
+    return os.path.getmtime(local_path)
+
+def versioned_name(prefix, source_version):
+    """
+    Returns the name of a view or table for one version of its source, so objects built
+    from different uploads or file versions never overwrite each other. The catalog is
+    shared by every session, so each session only ever queries its own versions.
+    """
+    return f"{prefix}_{hashlib.md5(str(source_version).encode()).hexdigest()[:12]}"
+
+@st.cache_resource
+def version_registry():
+    """
+    Returns a lock and, per table, the registered view names (least recently used
+    first). Shared by every session, like the connection.
+    """
+    return threading.Lock(), {table_name: [] for table_name in CLUSTER_KEYS}
+
+def retire_old_versions(con, table_name, view_name):
+    """
+    Marks `view_name` as the most recently used version of `table_name` and drops the
+    views, summary tables and upload registration of versions beyond MAX_SOURCE_VERSIONS.
+    """
+    lock, versions = version_registry()
+    with lock:
+        names = versions[table_name]
+        if view_name in names:
+            names.remove(view_name)
+        names.append(view_name)
+        retired = names[:-MAX_SOURCE_VERSIONS]
+        del names[:-MAX_SOURCE_VERSIONS]
+    for old in retired:
+        try:
+            con.execute(f"DROP TABLE IF EXISTS {old}_dates")
+            con.execute(f"DROP TABLE IF EXISTS {old}_snaps")
+            con.execute(f"DROP VIEW IF EXISTS {old}_dim")
+            con.execute(f"DROP VIEW IF EXISTS {old}")
+        except duckdb.TransactionException:
+            # Dropped concurrently by another session
+            pass
+        con.unregister(f"{old}_upload")
 
 def register_table(con, table_name, local_path, uploaded_file):
     """
-    Registers a table in DuckDB from either a local parquet file or an uploaded file.
-    Returns True if successful, False otherwise.
+    Registers a view over either a local parquet/CSV file or an uploaded file, named
+    after the source version (see `versioned_name`).
+    Returns the view name if successful, None otherwise.
     """
     try:
+        if uploaded_file is None and not os.path.exists(local_path):
+            return None
+        view_name = versioned_name(table_name, source_key(local_path, uploaded_file))
+        
         if uploaded_file is not None:
-            # For uploaded files, we might need to save them temp or read directly
-            # DuckDB can read from file-like objects in newer versions, 
-            # but usually it expects a path.
-            # Workaround: Streamlit stores uploaded files in RAM.
-            # We can write to a temp file or try to load bytes.
-            # For simplicity in this local context, let's write to a temp file.
+            # Decode the uploaded bytes into Arrow once and let DuckDB scan them in place
+            tbl = read_uploaded_table(uploaded_file.file_id, uploaded_file)
+            con.register(f"{view_name}_upload", tbl)
+            uploaded_tables[f"{view_name}_upload"] = tbl
             
-            with open(f"temp_{table_name}.parquet", "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
-            query = f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM 'temp_{table_name}.parquet'"
-            con.execute(query)
-            return True
-            
-        elif os.path.exists(local_path):
-            query = f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM '{local_path}'"
-            con.execute(query)
-            return True
+            query = f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM {view_name}_upload"
             
         else:
-            return False
+            clustered_path = cluster_parquet(con, local_path, CLUSTER_KEYS[table_name])
+            query = f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM {scan_sql(clustered_path)}"
+        
+        try:
+            con.execute(query)
+        except duckdb.TransactionException:
+            # Another session created the same view concurrently
+            pass
+        retire_old_versions(con, table_name, view_name)
+        return view_name
     except Exception as e:
         st.error(f"Error loading {table_name}: {e}")
-        return False
+        return None
+
+def register_dim(con, view_name, local_path, uploaded_file, columns):
+    """
+    Registers `<view_name>_dim` with the distinct key columns of the registered view,
+    backed by a skinny parquet for local parquet sources.
+    """
+    dim_path = None
+    if uploaded_file is None and local_path.lower().endswith(".parquet"):
+        dim_path = dim_parquet(con, local_path, columns)
+    if dim_path is not None:
+        query = f"CREATE OR REPLACE VIEW {view_name}_dim AS SELECT * FROM '{dim_path}'"
+    else:
+        cols = ", ".join(f'"{c}"' for c in columns)
+        query = f"CREATE OR REPLACE VIEW {view_name}_dim AS SELECT DISTINCT {cols} FROM {view_name}"
+    try:
+        con.execute(query)
+    except duckdb.TransactionException:
+        # Another session created the same view concurrently
+        pass
 
 # Register tables
-has_wf = register_table(con, 'waterfall', FILE_WATERFALL_PQ, uploaded_wf)
-has_daily = register_table(con, 'daily', FILE_DAILY_PQ, uploaded_daily)
-has_var = register_table(con, 'variance', FILE_VARIANCE_PQ, uploaded_var)
+path_wf = local_source(FILE_WATERFALL_PQ, FILE_WATERFALL_CSV)
+path_daily = local_source(FILE_DAILY_PQ, FILE_DAILY_CSV)
+path_var = local_source(FILE_VARIANCE_PQ, FILE_VARIANCE_CSV)
+
+wf_table = register_table(con, 'waterfall', path_wf, uploaded_wf)
+daily_table = register_table(con, 'daily', path_daily, uploaded_daily)
+var_table = register_table(con, 'variance', path_var, uploaded_var)
 
-if not (has_wf and has_daily):
-    st.warning("Please upload the required Parquet files or ensure they exist locally.")
+if not (wf_table and daily_table):
+    st.warning("Please upload the required Parquet/CSV files or ensure they exist locally.")
     st.info("Required: Waterfall Data and Daily Data.")
     st.stop()
-    
+
+register_dim(con, wf_table, path_wf, uploaded_wf, ["Inv Org", "Item Code", "Date"])
+register_dim(con, daily_table, path_daily, uploaded_daily, ["Inv Org", "Item Code", "Snapshot Date"])
+
+def build_summary_tables(con, wf_table, daily_table):
+    """
+    Materializes the small lookup tables behind the sidebar and tab selectors
+    from the version-named key-column views, once per source version. Tables that
+    already exist for these versions are left as they are; versions beyond
+    MAX_SOURCE_VERSIONS are dropped by `retire_old_versions`.
+    """
+    try:
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {wf_table}_dates AS
+            SELECT "Inv Org" AS o, "Item Code" AS i, list_sort(list_distinct(list(Date))) AS dates
+            FROM {wf_table}_dim
+            GROUP BY 1, 2
+        """)
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {daily_table}_snaps AS
+            SELECT "Inv Org" AS o, "Item Code" AS i, list_sort(list_distinct(list("Snapshot Date"))) AS s
+            FROM {daily_table}_dim
+            GROUP BY 1, 2
+        """)
+    except duckdb.TransactionException:
+        # Another session created the same table concurrently
+        pass
+
+build_summary_tables(con, wf_table, daily_table)
+
 # Check row counts efficiently
-row_count = con.execute("SELECT COUNT(*) FROM waterfall").fetchone()[0]
+row_count = con.execute(f"SELECT COUNT(*) FROM {wf_table}").fetchone()[0]
 st.sidebar.info(f"Loaded {row_count:,} waterfall rows (DuckDB).")
 
+# =============================================================================
+# CACHED QUERIES
+# =============================================================================
+# Results are cached by the selection (plus the version-named table), so
+# switching tabs, re-rendering or touching the sidebar does not re-parse and
+# re-run the SQL. The connection itself is never an argument; each call opens
+# its own cursor on the shared module-level `con`. Nothing is prepared: SQL
+# PREPARE statements only exist on the cursor that ran them, so they cannot be
+# shared with these per-call cursors, and a cache miss still parses and plans.
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_orgs(wf_table):
+    """
+    Returns the sorted list of Inv Orgs in the waterfall summary.
+    """
+    return [row[0] for row in db_cursor().execute(
+        f"SELECT DISTINCT o FROM {wf_table}_dates ORDER BY 1"
+    ).fetchall()]
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_items(org, wf_table):
+    """
+    Returns the sorted list of Item Codes available for an Inv Org.
+    """
+    return [row[0] for row in db_cursor().execute(
+        f"SELECT i FROM {wf_table}_dates WHERE o = ? ORDER BY 1", [org]
+    ).fetchall()]
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_snapshots(item, org, daily_table):
+    """
+    Returns the planning snapshot dates available in the daily data for one item.
+    """
+    return pd.DatetimeIndex(db_cursor().execute(f"""
+        SELECT unnest(s) AS "Snapshot Date" FROM {daily_table}_snaps WHERE i = ? AND o = ?
+    """, [item, org]).fetchnumpy()['Snapshot Date'])
+
+def downsample_sql(x, ys, n_points=MAX_PLOT_POINTS):
+    """
+    Returns the tail of a query that downsamples the CTE `src` with
+    Largest-Triangle-Three-Buckets: rows are split into buckets along `x` and, for
+    each y column, the row forming the largest triangle with the neighbouring bucket
+    averages is kept (plus the first and last rows). All y columns share the returned
+    rows, so the bucket budget is split between them to keep every trace within
+    `n_points`. Series that already fit are returned unchanged.
+    """
+    n_buckets = max(1, (n_points - 2) // len(ys))
+    avgs = ", ".join(f"avg({y}) AS _avg{k}" for k, y in enumerate(ys))
+    areas = ", ".join(
+        f"abs((p._x - q._x) * ({y} - p._avg{k}) - (p._x - b._x) * (q._avg{k} - p._avg{k})) AS _area{k}"
+        for k, y in enumerate(ys)
+    )
+    area_cols = ", ".join(f"_area{k}" for k in range(len(ys)))
+    picks = " OR ".join(
+        f"row_number() OVER (PARTITION BY _bucket ORDER BY _area{k} DESC NULLS LAST) = 1"
+        for k in range(len(ys))
+    )
+    return f"""
+        _b AS (
+            SELECT *, epoch({x}) AS _x,
+                   row_number() OVER (ORDER BY {x}) AS _rn,
+                   COUNT(*) OVER () AS _n,
+                   CASE WHEN COUNT(*) OVER () <= {n_points} THEN row_number() OVER (ORDER BY {x})
+                        ELSE ntile({n_buckets}) OVER (ORDER BY {x}) END AS _bucket
+            FROM src
+        ),
+        _g AS (
+            SELECT _bucket, avg(_x) AS _x, {avgs}
+            FROM _b
+            GROUP BY _bucket
+        ),
+        _a AS (
+            SELECT b.*, {areas}
+            FROM _b b
+            LEFT JOIN _g p ON p._bucket = b._bucket - 1
+            LEFT JOIN _g q ON q._bucket = b._bucket + 1
+        )
+        SELECT * EXCLUDE (_x, _rn, _n, _bucket, {area_cols})
+        FROM _a
+        QUALIFY _rn = 1 OR _rn = _n OR {picks}
+        ORDER BY {x}
+    """
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_waterfall(item, org, date, wf_table):
+    """
+    Returns the available target dates, the target date used (and its label) and the
+    Base + Deltas + Final waterfall arrays (x, measure, y) from a single query, plus the
+    per-snapshot detail rows shown under the chart. All axis
+    and title labels are formatted by DuckDB. `date` falls back to the first
+    available target date when it is None or not available for this item.
+    The base is the earliest snapshot's inventory and each delta is taken against the
+    previous snapshot with LAG(), so the stored previous-snapshot columns are not read.
+    Above MAX_WATERFALL_BARS snapshots, deltas are summed into weekly bars.
+    """
+    row = db_cursor().execute(f"""
+        WITH d AS (
+            SELECT dates, COALESCE(list_filter(dates, t -> t = ?)[1], dates[1]) AS target
+            FROM {wf_table}_dates
+            WHERE i = ? AND o = ?
+        ),
+        w AS (
+            SELECT "Snapshot Date", "Tot.Inventory_daily",
+                   LAG("Snapshot Date") OVER (ORDER BY "Snapshot Date") AS prev_snap,
+                   LAG("Tot.Inventory_daily") OVER (ORDER BY "Snapshot Date") AS prev_inv,
+                   "Tot.Inventory_daily" - LAG("Tot.Inventory_daily") OVER (ORDER BY "Snapshot Date") AS delta,
+                   COUNT(*) OVER () > {MAX_WATERFALL_BARS} AS weekly
+            FROM {wf_table}, d
+            WHERE "Item Code" = ? 
+              AND "Inv Org" = ? 
+              AND Date = d.target
+        ),
+        bars AS (
+            SELECT 0 AS part, MIN("Snapshot Date") AS snap,
+                   'Base (' || strftime(MIN("Snapshot Date"), '%m-%d') || ')' AS x,
+                   'absolute' AS measure,
+                   arg_min("Tot.Inventory_daily", "Snapshot Date") AS y
+            FROM w
+            HAVING COUNT(*) > 0
+            UNION ALL
+            SELECT 1, bar, CASE WHEN weekly THEN 'Wk ' ELSE '' END || strftime(bar, '%m-%d'), 'relative', SUM(delta)
+            FROM (
+                SELECT *, CASE WHEN weekly THEN date_trunc('week', "Snapshot Date") ELSE "Snapshot Date" END AS bar
+                FROM w
+                WHERE delta IS NOT NULL
+            )
+            GROUP BY bar, weekly
+            UNION ALL
+            SELECT 2, MAX("Snapshot Date"), 'Final (' || strftime(MAX("Snapshot Date"), '%m-%d') || ')', 'total', NULL
+            FROM w
+            HAVING COUNT(*) > 0
+        )
+        SELECT d.dates, d.target, strftime(d.target, '%Y-%m-%d') AS target_lbl,
+               list(x ORDER BY part, snap) FILTER (WHERE part IS NOT NULL),
+               list(measure ORDER BY part, snap) FILTER (WHERE part IS NOT NULL),
+               list(y ORDER BY part, snap) FILTER (WHERE part IS NOT NULL),
+               dt.detail
+        FROM d
+        CROSS JOIN (
+            SELECT list({{
+                'Snapshot Date': "Snapshot Date", 'Previous Snapshot Date': prev_snap,
+                'Tot.Inventory_daily': "Tot.Inventory_daily", 'Tot.Inventory_previous': prev_inv,
+                'Delta_Inventory': delta
+            }} ORDER BY "Snapshot Date") AS detail
+            FROM w
+        ) dt
+        LEFT JOIN bars ON true
+        GROUP BY d.dates, d.target, target_lbl, dt.detail
+    """, [date, item, org, item, org]).fetchone()
+    
+    if row is None:
+        return {'dates': pd.DatetimeIndex([]), 'target': None, 'target_lbl': None,
+                'x': [], 'measure': [], 'y': [], 'detail': pd.DataFrame(columns=WATERFALL_DETAIL_COLUMNS)}
+    dates, target, target_lbl, x, measure, y, detail = row
+    return {'dates': pd.DatetimeIndex(dates), 'target': pd.Timestamp(target), 'target_lbl': target_lbl,
+            'x': x or [], 'measure': measure or [], 'y': y or [],
+            'detail': pd.DataFrame(detail or [], columns=WATERFALL_DETAIL_COLUMNS)}
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_daily(item, org, snap, daily_table):
+    """
+    Returns the supply vs demand timeline for one planning snapshot, downsampled for plotting.
+    The shortage total is computed over the full series before downsampling.
+    """
+    return db_cursor().execute(f"""
+        WITH src AS (
+            SELECT Date, "Tot.Inventory_daily", "Indep.Req_daily", "Net_Inventory_vs_Demand",
+                   SUM(LEAST("Net_Inventory_vs_Demand", 0)) OVER () AS "Total_Shortage"
+            FROM {daily_table}
+            WHERE "Item Code" = ? 
+              AND "Inv Org" = ?
+              AND "Snapshot Date" = ?
+        ),
+    """ + downsample_sql('Date', ['"Tot.Inventory_daily"', '"Indep.Req_daily"']), [item, org, snap]).fetch_arrow_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_variance(item, org, var_table):
+    """
+    Returns the demand forecast variance rows shown in the table for one item.
+    The key columns are dropped since they are fixed by the selection; every other
+    column is shown, so the full row width is read. At most MAX_TABLE_ROWS + 1 rows
+    are fetched, the extra row telling the caller the table was cut off.
+    """
+    return db_cursor().execute(f"""
+        SELECT * EXCLUDE ("Item Code", "Inv Org")
+        FROM {var_table}
+        WHERE "Item Code" = ? AND "Inv Org" = ?
+        ORDER BY Date
+        LIMIT {MAX_TABLE_ROWS + 1}
+    """, [item, org]).fetch_arrow_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+@st.cache_data(ttl=600, max_entries=256)
+def get_variance_points(item, org, var_table):
+    """
+    Returns the downsampled (Date, CV, mean) points for the variance scatter.
+    """
+    return db_cursor().execute(f"""
+        WITH src AS (
+            SELECT Date, cv_demand_forecast, mean_demand_forecast
+            FROM {var_table}
+            WHERE "Item Code" = ? AND "Inv Org" = ?
+        ),
+    """ + downsample_sql('Date', ['cv_demand_forecast']), [item, org]).fetch_arrow_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+# =============================================================================
+# CACHED FIGURES
+# =============================================================================
+# Figures are built once per selection and shared, so a rerun skips Plotly
+# figure construction and validation. They are kept as cache resources rather
+# than dicts because st.plotly_chart re-validates dict input into a Figure.
+
+@st.cache_resource(ttl=600, max_entries=256)
+def build_waterfall_fig(item, org, target, wf_table, _wf):
+    """
+    Builds the Tab 1 waterfall figure from the already fetched `_wf` rows.
+    `_wf` is not hashed; the figure is keyed on `target` (its `wf['target']`).
+    """
+    wf = _wf
+    base_inv = wf['y'][0]
+    
+    fig = go.Figure(go.Waterfall(
+        x=wf['x'], measure=wf['measure'], y=wf['y'], base=base_inv, # Base needs to start at 0 but visual base is first bar
+        # Actually, Plotly Waterfall 'base' param shifts the whole chart? 
+        # No, 'base' is usually 0. The first bar 'measure'='absolute' sets the level.
+        # Let's keep base=0.
+        decreasing={"marker":{"color":"#EF553B"}},
+        increasing={"marker":{"color":"#00CC96"}},
+        totals={"marker":{"color":"#636EFA"}}
+    ))
+    fig.update_layout(
+        title=f"Forecast Evolution for Target Date: {wf['target_lbl']}", 
+        xaxis_title="Planning Snapshot Date (When the plan was made)",
+        yaxis_title="Projected Inventory Quantity",
+        waterfallgap=0.3,
+        xaxis=dict(type='category'),
+        uirevision='const'
+    )
+    return fig
+
+@st.cache_resource(ttl=600, max_entries=256)
+def build_daily_fig(item, org, snap, daily_table):
+    """
+    Builds the Tab 2 supply vs demand figure for one planning snapshot.
+    """
+    ts_df = get_daily(item, org, snap, daily_table)
+    
+    fig2 = px.line(ts_df, x='Date', y=['Tot.Inventory_daily', 'Indep.Req_daily'],
+                   labels={'value': 'Quantity', 'variable': 'Metric'},
+                   title=f"Plan as of {snap.date()}")
+    return fig2
+
+@st.cache_resource(ttl=600, max_entries=256)
+def build_variance_fig(item, org, var_table):
+    """
+    Builds the Tab 3 demand volatility scatter.
+    """
+    var_pts = get_variance_points(item, org, var_table)
+    fig3 = px.scatter(var_pts, x='Date', y='cv_demand_forecast', 
+                      size='mean_demand_forecast',
+                      title="Demand Volatility (CV) over Time")
+    return fig3
+
 # =============================================================================
 # SIDEBAR FILTERS (SQL POWERED)
 # =============================================================================
 st.sidebar.header("Global Filters")
 
 # Org Filter
-# Efficient DISTINCT query
-all_orgs_res = con.execute("SELECT DISTINCT \"Inv Org\" FROM waterfall ORDER BY 1").fetchall()
-all_orgs = [row[0] for row in all_orgs_res]
+# Read from the materialized summary instead of scanning the fact table
+all_orgs = get_orgs(wf_table)
 
 selected_org = st.sidebar.selectbox("Select Inv Org", all_orgs)
 
 # Item Filter (Contextual)
 # SQL WHERE
-avail_items_res = con.execute(f"SELECT DISTINCT \"Item Code\" FROM waterfall WHERE \"Inv Org\" = ?", [selected_org]).fetchall()
-avail_items = sorted([row[0] for row in avail_items_res])
+avail_items = get_items(selected_org, wf_table)
 
 if not avail_items:
     st.sidebar.warning("No items found for this Org.")
@@ -109,137 +658,86 @@ selected_item = st.sidebar.selectbox("Select Item Code", avail_items)
 # =============================================================================
 # TABS
 # =============================================================================
-tab1, tab2, tab3 = st.tabs(["Waterfall Analysis", "Supply vs Demand", "Forecast Variance"])
-
-# --- TAB 1: WATERFALL ---
-with tab1:
-    st.subheader(f"Inventory Forecast Waterfall: {selected_item} @ {selected_org}")
-    
-    # 1. Get Available Dates
-    dates_res = con.execute("""
-        SELECT DISTINCT Date 
-        FROM waterfall 
-        WHERE "Item Code" = ? AND "Inv Org" = ? 
-        ORDER BY Date
-    """, [selected_item, selected_org]).fetchall()
+# Each tab renders as a fragment, so its own selectors only re-run its own queries
+@st.fragment
+def render_waterfall(item, org):
+    """
+    Tab 1: waterfall of the forecast for one target date across planning snapshots.
+    """
+    st.subheader(f"Inventory Forecast Waterfall: {item} @ {org}")
     
-    avail_dates = [pd.to_datetime(r[0]) for r in dates_res]
+    # 1. Available dates and the rows for the current (or default) target date in one query
+    wf = get_waterfall(item, org, st.session_state.get("wf_target_date"), wf_table)
     
-    if not avail_dates:
+    if wf['dates'].empty:
         st.warning("No waterfall data selection.")
     else:
-        target_date = st.selectbox("Select Forecast Target Date", avail_dates, index=0)
+        target_date = st.selectbox("Select Forecast Target Date", wf['dates'], index=0, key="wf_target_date")
         
         # 2. Get Data for Plot
-        # Fetch only relevant rows, sort in SQL
-        wf_df = con.execute("""
-            SELECT "Snapshot Date", "Previous Snapshot Date", "Tot.Inventory_daily", 
-                   "Tot.Inventory_previous", "Delta_Inventory"
-            FROM waterfall
-            WHERE "Item Code" = ? 
-              AND "Inv Org" = ? 
-              AND Date = ?
-            ORDER BY "Snapshot Date"
-        """, [selected_item, selected_org, target_date]).fetchdf()
+        # Only refetch if the widget settled on a different date than the one queried
+        if target_date != wf['target']:
+            wf = get_waterfall(item, org, target_date, wf_table)
         
-        if wf_df.empty:
+        if len(wf['x']) == 0:
             st.warning("No data found.")
         else:
-            # Ensure proper types
-            wf_df['Snapshot Date'] = pd.to_datetime(wf_df['Snapshot Date'])
-            wf_df['Previous Snapshot Date'] = pd.to_datetime(wf_df['Previous Snapshot Date'])
-            
-            # Logic: Base + Deltas
-            first_row = wf_df.iloc[0]
-            base_inv = first_row['Tot.Inventory_previous']
-            base_date = first_row['Previous Snapshot Date']
-            
-            # Formatted headers
-            latest_snap_date = wf_df['Snapshot Date'].max()
-            
-            x_vals = [f"Base ({base_date.strftime('%m-%d')})"] + \
-                     wf_df['Snapshot Date'].dt.strftime('%m-%d').tolist() + \
-                     [f"Final ({latest_snap_date.strftime('%m-%d')})"]
-            
-            y_vals = [base_inv] + wf_df['Delta_Inventory'].tolist() + [None]
-            measure = ["absolute"] + ["relative"] * len(wf_df) + ["total"]
-            
-            fig = go.Figure(go.Waterfall(
-                x=x_vals, measure=measure, y=y_vals, base=base_inv, # Base needs to start at 0 but visual base is first bar
-                # Actually, Plotly Waterfall 'base' param shifts the whole chart? 
-                # No, 'base' is usually 0. The first bar 'measure'='absolute' sets the level.
-                # Let's keep base=0.
-                decreasing={"marker":{"color":"#EF553B"}},
-                increasing={"marker":{"color":"#00CC96"}},
-                totals={"marker":{"color":"#636EFA"}}
-            ))
-            fig.update_layout(
-                title=f"Forecast Evolution for Target Date: {target_date.date()}", 
-                xaxis_title="Planning Snapshot Date (When the plan was made)",
-                yaxis_title="Projected Inventory Quantity",
-                waterfallgap=0.3,
-                xaxis=dict(type='category')
-            )
-            st.plotly_chart(fig, use_container_width=True)
-            st.dataframe(wf_df)
+            st.plotly_chart(build_waterfall_fig(item, org, wf['target'], wf_table, wf), use_container_width=True)
+            st.dataframe(wf['detail'])
 
-# --- TAB 2: SUPPLY vs DEMAND ---
-with tab2:
+@st.fragment
+def render_supply_demand(item, org):
+    """
+    Tab 2: supply vs demand timeline for one planning snapshot.
+    """
     st.subheader("Supply & Demand Timeline")
     
     # 1. Get Snaps from DAILY table
-    snaps_res = con.execute("""
-        SELECT DISTINCT "Snapshot Date" 
-        FROM daily 
-        WHERE "Item Code" = ? AND "Inv Org" = ?
-        ORDER BY 1
-    """, [selected_item, selected_org]).fetchall()
-    
-    all_snaps = [pd.to_datetime(r[0]) for r in snaps_res]
+    all_snaps = get_snapshots(item, org, daily_table)
     
-    if not all_snaps:
+    if all_snaps.empty:
         st.write("No daily data.")
     else:
         selected_snap = st.selectbox("Select Forecast Snapshot", all_snaps, index=len(all_snaps)-1)
         
-        ts_df = con.execute("""
-            SELECT Date, "Tot.Inventory_daily", "Indep.Req_daily", "Net_Inventory_vs_Demand"
-            FROM daily
-            WHERE "Item Code" = ? 
-              AND "Inv Org" = ?
-              AND "Snapshot Date" = ?
-            ORDER BY Date
-        """, [selected_item, selected_org, selected_snap]).fetchdf()
+        ts_df = get_daily(item, org, selected_snap, daily_table)
         
-        ts_df['Date'] = pd.to_datetime(ts_df['Date'])
+        st.plotly_chart(build_daily_fig(item, org, selected_snap, daily_table), use_container_width=True)
         
-        fig2 = px.line(ts_df, x='Date', y=['Tot.Inventory_daily', 'Indep.Req_daily'],
-                       labels={'value': 'Quantity', 'variable': 'Metric'},
-                       title=f"Plan as of {selected_snap.date()}")
-        st.plotly_chart(fig2, use_container_width=True)
-        
-        total_short = ts_df[ts_df['Net_Inventory_vs_Demand'] < 0]['Net_Inventory_vs_Demand'].sum()
+        # Shortage comes back with the frame
+        total_short = ts_df['Total_Shortage'].iat[0] if not ts_df.empty else 0
         st.metric("Total Cumulative Shortage", f"{total_short:,.0f}")
 
-# --- TAB 3: VARIANCE ---
-with tab3:
+@st.fragment
+def render_variance(item, org):
+    """
+    Tab 3: demand forecast variance for the selected item.
+    """
     st.subheader("Demand Forecast Variance")
     
-    if has_var:
-        var_df = con.execute("""
-            SELECT * 
-            FROM variance
-            WHERE "Item Code" = ? AND "Inv Org" = ?
-            ORDER BY Date
-        """, [selected_item, selected_org]).fetchdf()
+    if var_table:
+        var_df = get_variance(item, org, var_table)
         
+        if len(var_df) > MAX_TABLE_ROWS:
+            st.caption(f"Showing the first {MAX_TABLE_ROWS:,} rows by Date; the chart below uses all rows.")
+            var_df = var_df.head(MAX_TABLE_ROWS)
         st.dataframe(var_df)
         
         if not var_df.empty:
-            var_df['Date'] = pd.to_datetime(var_df['Date'])
-            fig3 = px.scatter(var_df, x='Date', y='cv_demand_forecast', 
-                              size='mean_demand_forecast',
-                              title="Demand Volatility (CV) over Time")
-            st.plotly_chart(fig3, use_container_width=True)
+            st.plotly_chart(build_variance_fig(item, org, var_table), use_container_width=True)
     else:
         st.warning("Variance data not uploaded.")
+
+tab1, tab2, tab3 = st.tabs(["Waterfall Analysis", "Supply vs Demand", "Forecast Variance"])
+
+# --- TAB 1: WATERFALL ---
+with tab1:
+    render_waterfall(selected_item, selected_org)
+
+# --- TAB 2: SUPPLY vs DEMAND ---
+with tab2:
+    render_supply_demand(selected_item, selected_org)
+
+# --- TAB 3: VARIANCE ---
+with tab3:
+    render_variance(selected_item, selected_org)